@@ -1,53 +1,99 @@
+import re
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from collections import OrderedDict
+from torch.hub import load_state_dict_from_url
 from .build import BACKBONE_REGISTRY
 from .backbone import Backbone
 from detectron2.modeling import ShapeSpec
 
-__all__ = ['VoVNet', 'vovnet27_slim', 'vovnet39', 'vovnet57']
+__all__ = ['VoVNet', 'VoVNetGraphRunner', 'vovnet27_slim', 'vovnet39', 'vovnet57']
 
 model_urls = {
     'vovnet39': 'https://dl.dropbox.com/s/1lnzsgnixd8gjra/vovnet39_torchvision.pth?dl=1',
     'vovnet57': 'https://dl.dropbox.com/s/6bfu9gstbwfw31m/vovnet57_torchvision.pth?dl=1'
 }
 
+def _make(module_cls, *args, skip_init=False, **kwargs):
+    """Construct a module, leaving its parameters uninitialized if asked to."""
+    if skip_init:
+        return torch.nn.utils.skip_init(module_cls, *args, **kwargs)
+    return module_cls(*args, **kwargs)
 
-def conv3x3(in_channels, out_channels, module_name, postfix,
-            stride=1, groups=1, kernel_size=3, padding=1):
+
+def conv3x3(in_channels, out_channels,
+            stride=1, groups=1, kernel_size=3, padding=1,
+            relu=None, skip_init=False):
     """3x3 convolution with padding"""
-    return [
-        ('{}_{}/conv'.format(module_name, postfix),
-         nn.Conv2d(in_channels, out_channels,
-                   kernel_size=kernel_size,
-                   stride=stride,
-                   padding=padding,
-                   groups=groups,
-                   bias=False)),
-        ('{}_{}/norm'.format(module_name, postfix),
-         nn.BatchNorm2d(out_channels)),
-        ('{}_{}/relu'.format(module_name, postfix),
-         nn.ReLU(inplace=True)),
-    ]
-
-
-def conv1x1(in_channels, out_channels, module_name, postfix,
-            stride=1, groups=1, kernel_size=1, padding=0):
+    return nn.Sequential(
+        _make(nn.Conv2d, in_channels, out_channels,
+              kernel_size=kernel_size,
+              stride=stride,
+              padding=padding,
+              groups=groups,
+              bias=False,
+              skip_init=skip_init),
+        _make(nn.BatchNorm2d, out_channels, skip_init=skip_init),
+        relu if relu is not None else nn.ReLU(inplace=True))
+
+
+def conv1x1(in_channels, out_channels,
+            stride=1, groups=1, kernel_size=1, padding=0,
+            relu=None, skip_init=False):
     """1x1 convolution"""
-    return [
-        ('{}_{}/conv'.format(module_name, postfix),
-         nn.Conv2d(in_channels, out_channels,
-                   kernel_size=kernel_size,
-                   stride=stride,
-                   padding=padding,
-                   groups=groups,
-                   bias=False)),
-        ('{}_{}/norm'.format(module_name, postfix),
-         nn.BatchNorm2d(out_channels)),
-        ('{}_{}/relu'.format(module_name, postfix),
-         nn.ReLU(inplace=True)),
-    ]
+    return nn.Sequential(
+        _make(nn.Conv2d, in_channels, out_channels,
+              kernel_size=kernel_size,
+              stride=stride,
+              padding=padding,
+              groups=groups,
+              bias=False,
+              skip_init=skip_init),
+        _make(nn.BatchNorm2d, out_channels, skip_init=skip_init),
+        relu if relu is not None else nn.ReLU(inplace=True))
+
+
+# Released checkpoints name each layer '{module}_{postfix}/{conv,norm}', e.g.
+# 'stage2.OSA2_1.layers.0.OSA2_1_0/conv.weight' or 'stem.stem_2/norm.bias'.
+_LEGACY_KEY = re.compile(
+    r'^(?P<head>(?:.*\.)?)(?P<name>[^./]+)/(?P<kind>conv|norm)\.(?P<param>[^.]+)$')
+
+
+def _remap_legacy_key(key):
+    """Map a named-layer checkpoint key onto the indexed nn.Sequential layout."""
+    m = _LEGACY_KEY.match(key)
+    if m is None:
+        return key
+    index = 0 if m.group('kind') == 'conv' else 1
+    if m.group('name').startswith('stem_'):
+        # the stem is a single flat Sequential of three conv-bn-relu triples
+        index += 3 * (int(m.group('name')[len('stem_'):]) - 1)
+    return '{}{}.{}'.format(m.group('head'), index, m.group('param'))
+
+
+class FusedCBR(nn.Module):
+    """Conv2d with an inference-mode BatchNorm folded in, followed by ReLU."""
+
+    def __init__(self, conv, bn):
+        super(FusedCBR, self).__init__()
+        with torch.no_grad():
+            scale = bn.weight * torch.rsqrt(bn.running_var + bn.eps)
+            weight = conv.weight * scale.view(-1, 1, 1, 1)
+            bias = bn.bias - bn.running_mean * scale
+            if conv.bias is not None:
+                bias = bias + conv.bias * scale
+        self.weight = nn.Parameter(
+            weight.contiguous(memory_format=torch.channels_last))
+        self.bias = nn.Parameter(bias)
+        self.stride = conv.stride
+        self.padding = conv.padding
+        self.dilation = conv.dilation
+        self.groups = conv.groups
+
+    def forward(self, x):
+        out = F.conv2d(x, self.weight, self.bias, self.stride,
+                       self.padding, self.dilation, self.groups)
+        return F.relu_(out)
 
 
 class _OSA_module(nn.Module):
@@ -56,22 +102,23 @@ class _OSA_module(nn.Module):
                  stage_ch,
                  concat_ch,
                  layer_per_block,
-                 module_name,
-                 identity=False):
+                 identity=False,
+                 relu=None,
+                 skip_init=False):
         super(_OSA_module, self).__init__()
 
         self.identity = identity
         self.layers = nn.ModuleList()
         in_channel = in_ch
         for i in range(layer_per_block):
-            self.layers.append(nn.Sequential(
-                OrderedDict(conv3x3(in_channel, stage_ch, module_name, i))))
+            self.layers.append(conv3x3(in_channel, stage_ch,
+                                       relu=relu, skip_init=skip_init))
             in_channel = stage_ch
 
         # feature aggregation
         in_channel = in_ch + layer_per_block * stage_ch
-        self.concat = nn.Sequential(
-            OrderedDict(conv1x1(in_channel, concat_ch, module_name, 'concat')))
+        self.concat = conv1x1(in_channel, concat_ch,
+                              relu=relu, skip_init=skip_init)
 
     def forward(self, x):
         identity_feat = x
@@ -85,7 +132,12 @@ class _OSA_module(nn.Module):
         xt = self.concat(x)
 
         if self.identity:
-            xt = xt + identity_feat
+            # xt is the output of an in-place ReLU, which autograd saves for
+            # backward, so only add in place when no graph is being recorded
+            if torch.is_grad_enabled():
+                xt = xt + identity_feat
+            else:
+                xt.add_(identity_feat)
 
         return xt
 
@@ -97,12 +149,14 @@ class _OSA_stage(nn.Sequential):
                  concat_ch,
                  block_per_stage,
                  layer_per_block,
-                 stage_num):
+                 stage_num,
+                 relu=None,
+                 skip_init=False):
         super(_OSA_stage, self).__init__()
 
-        if not stage_num == 2:
-            self.add_module('Pooling',
-                            nn.MaxPool2d(kernel_size=3, stride=2, ceil_mode=True))
+        # stages after the first downsample with a max-pool, applied
+        # functionally in forward rather than as a separate submodule
+        self.downsample = not stage_num == 2
 
         module_name = f'OSA{stage_num}_1'
         self.add_module(module_name,
@@ -110,7 +164,8 @@ class _OSA_stage(nn.Sequential):
                                     stage_ch,
                                     concat_ch,
                                     layer_per_block,
-                                    module_name))
+                                    relu=relu,
+                                    skip_init=skip_init))
         for i in range(block_per_stage - 1):
             module_name = f'OSA{stage_num}_{i + 2}'
             self.add_module(module_name,
@@ -118,8 +173,16 @@ class _OSA_stage(nn.Sequential):
                                         stage_ch,
                                         concat_ch,
                                         layer_per_block,
-                                        module_name,
-                                        identity=True))
+                                        identity=True,
+                                        relu=relu,
+                                        skip_init=skip_init))
+
+    def forward(self, x):
+        if self.downsample:
+            x = F.max_pool2d(x, kernel_size=3, stride=2, ceil_mode=True)
+        for module in self:
+            x = module(x)
+        return x
 
 
 class VoVNet(Backbone):
@@ -128,14 +191,19 @@ class VoVNet(Backbone):
                  config_concat_ch,
                  block_per_stage,
                  layer_per_block,
-                 num_classes=1000):
+                 num_classes=1000,
+                 skip_init=False):
         super(VoVNet, self).__init__()
 
+        # ReLU has no parameters or state, so one instance is shared by
+        # every layer of this model
+        relu = nn.ReLU(inplace=True)
+
         # Stem module
-        stem = conv3x3(3, 64, 'stem', '1', 2)
-        stem += conv3x3(64, 64, 'stem', '2', 1)
-        stem += conv3x3(64, 128, 'stem', '3', 2)
-        self.add_module('stem', nn.Sequential(OrderedDict(stem)))
+        self.add_module('stem', nn.Sequential(
+            *conv3x3(3, 64, 2, relu=relu, skip_init=skip_init),
+            *conv3x3(64, 64, 1, relu=relu, skip_init=skip_init),
+            *conv3x3(64, 128, 2, relu=relu, skip_init=skip_init)))
 
         stem_out_ch = [128]
         in_ch_list = stem_out_ch + config_concat_ch[:-1]
@@ -149,10 +217,27 @@ class VoVNet(Backbone):
                                        config_concat_ch[i],
                                        block_per_stage[i],
                                        layer_per_block,
-                                       i + 2))
+                                       i + 2,
+                                       relu=relu,
+                                       skip_init=skip_init))
+
+        self.classifier = _make(nn.Linear, config_concat_ch[-1], num_classes,
+                                skip_init=skip_init)
 
-        self.classifier = nn.Linear(config_concat_ch[-1], num_classes)
+        self._output_shape = {
+            'res%d' % (i + 2): ShapeSpec(channels=config_concat_ch[i],
+                                         stride=2 ** (i + 2))
+            for i in range(4)}
 
+        # with skip_init every value is about to be overwritten by a
+        # pretrained state dict, so leave the parameters uninitialized
+        if not skip_init:
+            self._init_weights()
+
+        # NHWC lets cuDNN pick its tensor-core conv kernels
+        self.to(memory_format=torch.channels_last)
+
+    def _init_weights(self):
         for m in self.modules():
             if isinstance(m, nn.Conv2d):
                 nn.init.kaiming_normal_(m.weight)
@@ -163,25 +248,126 @@ class VoVNet(Backbone):
                 nn.init.constant_(m.bias, 0)
 
     def forward(self, x):
-        outputs={}
+        x = x.contiguous(memory_format=torch.channels_last)
         x = self.stem(x)
-        x=self.stage2(x)
-        outputs['res2']=x
-        x=self.stage3(x)
-        outputs['res3']=x
-        x=self.stage4(x)
-        outputs['res4']=x
-        x=self.stage5(x)
-        outputs['res5']=x
-
-        return outputs
+        res2 = self.stage2(x)
+        res3 = self.stage3(res2)
+        res4 = self.stage4(res3)
+        res5 = self.stage5(res4)
+
+        return {'res2': res2, 'res3': res3, 'res4': res4, 'res5': res5}
+
+    def compile_for_inference(self):
+        """Return a ``torch.compile``-d model with CUDA-graph trees enabled."""
+        return torch.compile(self, dynamic=False, mode='reduce-overhead')
+
+    def forward_amp(self, x, dtype=torch.bfloat16):
+        """Run ``forward`` under autocast with the given reduced precision."""
+        with torch.autocast(x.device.type, dtype=dtype):
+            return self.forward(x)
+
+    def to_bf16_inference(self, dtype=torch.bfloat16):
+        """Fuse Conv-BN-ReLU and cast the fused weights to ``dtype``.
+
+        Inputs must be cast to the same dtype before calling the model.
+        """
+        self.eval()
+        self.fuse_for_inference()
+        return self.to(dtype=dtype)
+
+    def fuse_for_inference(self):
+        """Replace every Conv-BN-ReLU triple with a single :class:`FusedCBR`.
+
+        Must be called after ``.eval()``; the model is modified in place.
+        """
+        assert not self.training, 'fuse_for_inference requires eval mode'
+        for m in list(self.modules()):
+            if not isinstance(m, nn.Sequential):
+                continue
+            children = list(m._modules.items())
+            for i in range(len(children) - 2):
+                (name, conv), (bn_name, bn), (relu_name, relu) = children[i:i + 3]
+                if (type(conv) is nn.Conv2d and isinstance(bn, nn.BatchNorm2d)
+                        and isinstance(relu, nn.ReLU)):
+                    # Sequential children are keyed by string, so deleting
+                    # the BN and ReLU slots leaves the other indices intact
+                    m._modules[name] = FusedCBR(conv, bn)
+                    del m._modules[bn_name]
+                    del m._modules[relu_name]
+        return self
+
+    def script_for_inference(self):
+        """Return a fused, frozen TorchScript module optimized for inference."""
+        self.eval()
+        self.fuse_for_inference()
+        return torch.jit.optimize_for_inference(torch.jit.freeze(torch.jit.script(self)))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        for key in [k for k in state_dict if k.startswith(prefix)]:
+            new_key = prefix + _remap_legacy_key(key[len(prefix):])
+            if new_key != key:
+                state_dict[new_key] = state_dict.pop(key)
+        super(VoVNet, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def output_shape(self):
+        return dict(self._output_shape)
+
+
+class VoVNetGraphRunner(object):
+    """Replay a VoVNet forward pass from a captured CUDA graph.
+
+    One graph is captured per input (device, dtype, H, W) for a fixed batch
+    size. The
+    model must be in eval mode, otherwise the BN running-stat updates would
+    be baked into every replay. The returned features are cloned out of the
+    graph's static output buffers.
+    """
 
-        return {'res2': ShapeSpec(channels=256, stride=4),
-                'res3': ShapeSpec(channels=512, stride=8),
-                'res4': ShapeSpec(channels=768, stride=16),
-                'res5': ShapeSpec(channels=1024, stride=32)}
+    def __init__(self, model, batch_size=1, num_warmup=3):
+        if model.training:
+            raise ValueError('VoVNetGraphRunner requires a model in eval mode')
+        self.model = model
+        self.batch_size = batch_size
+        self.num_warmup = num_warmup
+        self._graphs = {}
+
+    @torch.no_grad()
+    def _capture(self, x):
+        if self.model.training:
+            raise ValueError('VoVNetGraphRunner requires a model in eval mode')
+        # fixed layout, so replays do not depend on the caller's memory format
+        static_in = torch.empty(x.shape, dtype=x.dtype, device=x.device,
+                                memory_format=torch.channels_last)
+        static_in.copy_(x)
+
+        # warm up on a side stream so lazy init (cuDNN autotuning etc.)
+        # does not end up inside the graph
+        s = torch.cuda.Stream()
+        s.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(s):
+            for _ in range(self.num_warmup):
+                self.model(static_in)
+        torch.cuda.current_stream().wait_stream(s)
+
+        g = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(g):
+            static_outs = self.model(static_in)
+        return g, static_in, static_outs
+
+    @torch.no_grad()
+    def __call__(self, x):
+        if not x.is_cuda or x.size(0) != self.batch_size:
+            raise ValueError('expected a CUDA input with batch size {}'.format(
+                self.batch_size))
+        key = (x.device, x.dtype) + tuple(x.shape[-2:])
+        if key not in self._graphs:
+            with torch.cuda.device(x.device):
+                self._graphs[key] = self._capture(x)
+        g, static_in, static_outs = self._graphs[key]
+        with torch.cuda.device(x.device):
+            static_in.copy_(x)
+            g.replay()
+        return {k: v.clone() for k, v in static_outs.items()}
 
 
 def _vovnet(arch,
@@ -192,6 +378,7 @@ def _vovnet(arch,
             pretrained,
             progress,
             **kwargs):
+    kwargs.setdefault('skip_init', pretrained)
     model = VoVNet(config_stage_ch, config_concat_ch,
                    block_per_stage, layer_per_block,
                    **kwargs)